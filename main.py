@@ -9,14 +9,94 @@ import bs4
 import time
 import aiohttp
 import base64
+import hashlib
+import random
+import json
+import io
+import re
+import shutil
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 load_dotenv()
 client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+worker_api_keys = dict.fromkeys(
+    key for key in (os.getenv("GEMINI_API_KEY_" + str(i)) for i in range(3)) if key
+)
 worker_clients: list[Client] = [
-    genai.Client(api_key=os.getenv("GEMINI_API_KEY_" + str(i))) for i in range(3)
-]
+    genai.Client(api_key=key) for key in worker_api_keys
+] or [client]
+worker_semaphores = [asyncio.Semaphore(8) for _ in worker_clients]
+worker_model = "gemini-2.0-flash-lite"
 cf_ai_model = "@cf/black-forest-labs/flux-1-schnell"
 cf_ai_url = f"https://api.cloudflare.com/client/v4/accounts/{os.getenv("CF_ACCOUNT_ID")}/ai/run/{cf_ai_model}"
+section_cache_dir = ".cache/sections"
+image_cache_dir = ".cache/images"
+image_requests: dict[str, asyncio.Task] = {}
+image_semaphore = asyncio.Semaphore(16)
+image_max_attempts = 5
+image_max_backoff = 30
+image_chunk_size = 65536
+image_marker = re.compile(rb'"image"\s*:\s*"')
+json_decoder = json.JSONDecoder()
+
+planner_instructions = """
+The user wants to create a landing page.
+The landing page should be as big and useful as it can be.
+Create a plan of action which multiple LLMs will follow to build the website.
+The plan of action should be the different sections on the landing page.
+The plan of action must contain prompts which will be given to the website generation model.
+The section name will be used as the HTML ID of the section, so it must be a valid and unique ID.
+Include sizings for each section in the prompt.
+Put all repetitive information into the shared context.
+Explain the website in detail in the shared context.
+Set a font if needed.
+Add website style, colours, font theming, font colours, etc in the theme context.
+The prompt should be very DETAILED, and all the sections of the website should be very CONSISTENT.
+Also ask workers to add micro interactions and transitions to the hero elements.
+"""
+
+skeleton_instructions = """
+The user wants to create a landing page, and its sections have already been planned.
+Supply the HTML code containing the basic structure of the website, including the sections with their ID as the section name.
+The ID is very important, it must exactly match the section name.
+Include every planned section, in the given order.
+Include sizings for each section in the skeleton code, as described in the section prompts.
+DO NOT ADD ANY CODE EXCEPT BOILERPLATE/SKELETON CODE.
+Make sure you set the margins and padding to the body correctly.
+Use Tailwind for styling.
+This is the tag for TailwindCSS: <script src="https://unpkg.com/@tailwindcss/browser@4"></script>
+Include the Tailwind import tag in the skeleton.
+Set a font if needed.
+"""
+
+worker_instructions = """
+You are a worker being orchestrated by a master LLM.
+You have been assigned only this section.
+Only generate this section, nothing else.
+Use Tailwind CSS for styling.
+Add images to the image_prompts, and files should only be png file.
+All images will be saved to /static/{filename}
+Make the design look modern and futuristic.
+Include Custom JS and CSS for that section if needed.
+Add interactivity in the elements if needed.
+Also include any custom font.
+Add micro transitions in the hero sections.
+Avoid adding multiple images to a section if not needed.
+Make sure the text is readable and there is a contrast between the text and the background.
+There should be no background images with any text anywhere in the website.
+Buttons should have a contrasting foreground and background color.
+For images, constrain them to a fixed size and only display those.
+"""
+
+worker_prompt_template = (
+    "This is context about the website you are building: {shared_context}\n"
+    "This is the theming of the website: {theme_context}\n"
+    "Generate HTML Code for this prompt: {prompt}"
+)
 
 
 class PromptSchema(BaseModel):
@@ -36,12 +116,19 @@ class PlanningResponse(BaseModel):
     theme_context: Theming colours, values, padding values, etc.
     shared_context: Context which will be shared between LLMs when generating website.
     prompts: List of prompts which will be supplied to another LLM to generate output of the website. Should be individual sections of a page.
-    skeleton: The framework of the website, no actual code.
     """
 
     theme_context: str
     shared_context: str
     prompts: list[PromptSchema]
+
+
+class SkeletonResponse(BaseModel):
+    """
+    Response Model for the skeleton of the website
+    skeleton: The framework of the website, no actual code.
+    """
+
     skeleton: str
 
 
@@ -70,18 +157,112 @@ class WorkerResponse(BaseModel):
     js_code: Optional[str]
 
 
+def read_file(path: str):
+    with open(path) as f:
+        return f.read()
+
+
+def write_file(path: str, data, mode: str = "w"):
+    with open(path, mode) as f:
+        f.write(data)
+
+
+async def decode_image_stream(response, f):
+    pending = b""
+    in_image = False
+    async for chunk in response.content.iter_chunked(image_chunk_size):
+        pending += chunk
+        if not in_image:
+            match = image_marker.search(pending)
+            if not match:
+                pending = pending[-64:]
+                continue
+            pending = pending[match.end() :]
+            in_image = True
+        end = pending.find(b'"')
+        data = (pending if end == -1 else pending[:end]).replace(b"\\", b"")
+        usable = len(data) - len(data) % 4
+        await asyncio.to_thread(f.write, base64.b64decode(data[:usable]))
+        if end != -1:
+            return usable == len(data)
+        pending = data[usable:]
+    return False
+
+
+async def stream_image(response, path: str):
+    part_path = f"{path}.part"
+    saved = False
+    try:
+        with open(part_path, "wb") as f:
+            saved = await decode_image_stream(response, f)
+    finally:
+        if saved:
+            os.replace(part_path, path)
+        else:
+            os.remove(part_path)
+    return saved
+
+
+async def request_image(prompt, path, session):
+    for attempt in range(image_max_attempts):
+        delay = min(image_max_backoff, 2**attempt) + random.random()
+        try:
+            async with session.post(
+                cf_ai_url,
+                headers={"Authorization": f"Bearer {os.getenv("CF_API_KEY")}"},
+                json={"prompt": prompt},
+            ) as response:
+                if response.status != 429 and response.status < 500:
+                    return await stream_image(response, path)
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        if attempt + 1 < image_max_attempts:
+            await asyncio.sleep(delay)
+    return False
+
+
+async def fetch_image(prompt, path, session):
+    async with image_semaphore:
+        return await request_image(prompt, path, session)
+
+
 async def generate_image(prompt, filename, session):
-    response = await session.post(
-        cf_ai_url,
-        headers={"Authorization": f"Bearer {os.getenv("CF_API_KEY")}"},
-        json={"prompt": prompt},
-    )
-    response = await response.json()
-    if not response["success"]:
-        print(f"Could not generate image for: {prompt}")
-        return
-    with open(f"static/{filename}", "wb") as f:
-        f.write(base64.decodebytes(response["result"]["image"].encode()))
+    cache_key = hashlib.sha256(f"{cf_ai_model}\n{prompt}".encode()).hexdigest()
+    cache_path = f"{image_cache_dir}/{cache_key}.png"
+    if not os.path.exists(cache_path):
+        if cache_path not in image_requests:
+            os.makedirs(image_cache_dir, exist_ok=True)
+            image_requests[cache_path] = asyncio.create_task(
+                fetch_image(prompt, cache_path, session)
+            )
+        if not await image_requests[cache_path]:
+            print(f"Could not generate image for: {prompt}")
+            return
+    await asyncio.to_thread(shutil.copyfile, cache_path, f"static/{filename}")
+
+
+def start_image_tasks(image_prompts, session):
+    return [
+        asyncio.create_task(generate_image(i["prompt"], i["filename"], session))
+        for i in image_prompts
+    ]
+
+
+def parse_streamed_image_prompts(response_text: str):
+    start = response_text.find('"image_prompts"')
+    if start == -1:
+        return None
+    start = response_text.find("[", start)
+    if start == -1:
+        return None
+    try:
+        image_prompts, _ = json_decoder.raw_decode(response_text, start)
+    except json.JSONDecodeError:
+        return None
+    return image_prompts
 
 
 async def generate_section(
@@ -89,124 +270,156 @@ async def generate_section(
     shared_context: str,
     theme_context: str,
     section_name: str,
+    session: aiohttp.ClientSession,
     index: int = 0,
 ):
+    cache_key = hashlib.sha256(
+        "\n".join(
+            [
+                worker_model,
+                worker_instructions,
+                worker_prompt_template,
+                section_name,
+                theme_context,
+                shared_context,
+                prompt,
+            ]
+        ).encode()
+    ).hexdigest()
+    cache_path = f"{section_cache_dir}/{cache_key}.json"
+    if os.path.exists(cache_path):
+        cached = json.loads(await asyncio.to_thread(read_file, cache_path))
+        return (
+            section_name,
+            cached["html_code"],
+            cached.get("css_code"),
+            cached.get("js_code"),
+            start_image_tasks(cached["image_prompts"], session),
+        )
     worker = worker_clients[index % len(worker_clients)]
-    worker_response = await worker.aio.models.generate_content(
-        model="gemini-2.0-flash-lite",
-        contents=f"""
-        This is context about the website you are building: {shared_context}
-        This is the theming of the website: {theme_context}
-        Generate HTML Code for this prompt: {prompt}
-        You are a worker being orchestrated by a master LLM.
-        You have been assigned only this section.
-        Only generate this section, nothing else.
-        Use Tailwind CSS for styling.
-        Add images to the image_prompts, and files should only be png file.
-        All images will be saved to /static/{"{filename}"}
-        Make the design look modern and futuristic.
-        Include Custom JS and CSS for that section if needed.
-        Add interactivity in the elements if needed.
-        Also include any custom font.
-        Add micro transitions in the hero sections.
-        Avoid adding multiple images to a section if not needed.
-        Make sure the text is readable and there is a contrast between the text and the background.
-        There should be no background images with any text anywhere in the website.
-        Buttons should have a contrasting foreground and background color.
-        For images, constrain them to a fixed size and only display those.
-        """,
+    response_text = ""
+    image_tasks = None
+    async with worker_semaphores[index % len(worker_clients)]:
+        async for chunk in await worker.aio.models.generate_content_stream(
+            model=worker_model,
+            contents=worker_prompt_template.format(
+                shared_context=shared_context,
+                theme_context=theme_context,
+                prompt=prompt,
+            ),
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": WorkerResponse,
+                "system_instruction": worker_instructions,
+            },
+        ):
+            response_text += chunk.text or ""
+            if image_tasks is None:
+                image_prompts = parse_streamed_image_prompts(response_text)
+                if image_prompts is not None:
+                    image_tasks = start_image_tasks(image_prompts, session)
+    worker_response = json.loads(response_text)
+    if image_tasks is None:
+        image_tasks = start_image_tasks(worker_response["image_prompts"], session)
+    os.makedirs(section_cache_dir, exist_ok=True)
+    await asyncio.to_thread(write_file, cache_path, response_text)
+    return (
+        section_name,
+        worker_response["html_code"],
+        worker_response.get("css_code"),
+        worker_response.get("js_code"),
+        image_tasks,
+    )
+
+
+async def generate_skeleton(prompt: str, plan: PlanningResponse):
+    sections = "\n".join(f"{i.section_name}: {i.prompt}" for i in plan.prompts)
+    skeleton_response = await client.aio.models.generate_content(
+        model="gemini-2.0-flash",
+        contents=(
+            f"This is the prompt of the user: {prompt}\n"
+            f"This is the theming of the website: {plan.theme_context}\n"
+            f"These are the sections of the website:\n{sections}"
+        ),
         config={
             "response_mime_type": "application/json",
-            "response_schema": WorkerResponse,
+            "response_schema": SkeletonResponse,
+            "system_instruction": skeleton_instructions,
         },
     )
-    return (
-        section_name,
-        worker_response.parsed.html_code,
-        worker_response.parsed.css_code,
-        worker_response.parsed.js_code,
-        worker_response.parsed.image_prompts,
-    )
+    return skeleton_response.parsed.skeleton
 
 
 async def main():
     prompt = input(" > ")
     plan_response = await client.aio.models.generate_content(
         model="gemini-2.0-flash",
-        contents=f"""
-        This is the prompt of the user: {prompt}
-        The user wants to create a landing page.
-        The landing page should be as big and useful as it can be.
-        Create a plan of action which multiple LLMs will follow to build the website.
-        The plan of action should be the different sections on the landing page.
-        The plan of action must contain prompts which will be given to the website generation model.
-        Also, supply the HTML code containing the basic structure of the website, including the sections with their ID as the section name.
-        The ID is very important,
-        Include sizings for each section in the skeleton code, and share them in the prompt as well.
-        DO NOT ADD ANY CODE EXCEPT BOILERPLATE/SKELETON CODE.
-        Make sure you set the margins and padding to the body correctly.
-        Use Tailwind for styling.
-        This is the tag for TailwindCSS: <script src="https://unpkg.com/@tailwindcss/browser@4"></script>
-        Include the Tailwind import tag in the skeleton.
-        Put all repetitive information into the shared context.
-        Explain the website in detail in the shared context.
-        Set a font if needed.
-        Add website style, colours, font theming, font colours, etc in the theme context.
-        The prompt should be very DETAILED, and all the sections of the website should be very CONSISTENT.
-        Also ask workers to add micro interactions and transitions to the hero elements.
-        """,
+        contents=f"This is the prompt of the user: {prompt}",
         config={
             "response_mime_type": "application/json",
             "response_schema": PlanningResponse,
+            "system_instruction": planner_instructions,
         },
     )
     print("Theme:", plan_response.parsed.theme_context)
     print("Context:", plan_response.parsed.shared_context)
-    skeleton_soup = bs4.BeautifulSoup(plan_response.parsed.skeleton, "html.parser")
-    tasks = []
-    for i, plan_item in enumerate(plan_response.parsed.prompts):
-        print(f"Prompt ({plan_item.section_name}): {plan_item.prompt}")
-        tasks.append(
-            generate_section(
-                plan_item.prompt,
-                plan_response.parsed.shared_context,
-                plan_response.parsed.theme_context,
-                plan_item.section_name,
-                i,
+    skeleton_task = asyncio.create_task(generate_skeleton(prompt, plan_response.parsed))
+    connector = aiohttp.TCPConnector(limit_per_host=64, keepalive_timeout=75)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=aiohttp.ClientTimeout(total=60)
+    ) as aiohttp_session:
+        tasks = []
+        for i, plan_item in enumerate(plan_response.parsed.prompts):
+            print(f"Prompt ({plan_item.section_name}): {plan_item.prompt}")
+            tasks.append(
+                asyncio.create_task(
+                    generate_section(
+                        plan_item.prompt,
+                        plan_response.parsed.shared_context,
+                        plan_response.parsed.theme_context,
+                        plan_item.section_name,
+                        aiohttp_session,
+                        i,
+                    )
+                )
             )
+        skeleton_soup = bs4.BeautifulSoup(await skeleton_task, "html.parser")
+        skeleton_sections = {tag["id"]: tag for tag in skeleton_soup.find_all(id=True)}
+        collected_image_tasks = []
+        css = io.StringIO()
+        js = io.StringIO()
+        for result in asyncio.as_completed(tasks):
+            section, html_snippet, _, _, image_tasks = await result
+            collected_image_tasks.extend(image_tasks)
+            s = skeleton_sections.get(section)
+            if not s or not any(p is skeleton_soup for p in s.parents):
+                print(f"Section {section} not found in skeleton")
+                continue
+            s.replace_with(bs4.BeautifulSoup(html_snippet, "html.parser"))
+        for task in tasks:
+            _, _, css_snippet, js_snippet, _ = task.result()
+            if css_snippet:
+                css.write(css_snippet)
+                css.write("\n")
+            if js_snippet:
+                js.write(js_snippet)
+                js.write("\n")
+        script = skeleton_soup.new_tag("script")
+        script.string = f"\n{js.getvalue()}"
+        style = skeleton_soup.new_tag("style")
+        style.string = f"\n{css.getvalue()}"
+        skeleton_soup.head.append(script)
+        skeleton_soup.head.append(style)
+        output = str(skeleton_soup)
+        await asyncio.gather(
+            asyncio.to_thread(write_file, "index.html", output),
+            *collected_image_tasks,
         )
-    results = await asyncio.gather(*tasks)
-    collected_image_prompts = []
-    css = []
-    js = []
-    aiohttp_session = aiohttp.ClientSession()
-    for section, html_snippet, css_snippet, js_snippet, image_prompts in results:
-        collected_image_prompts.extend(
-            [
-                generate_image(i.prompt, i.filename, aiohttp_session)
-                for i in image_prompts
-            ]
-        )
-        css.append(css_snippet)
-        js.append(js_snippet)
-        s = skeleton_soup.find(id=section)
-        if not s:
-            print(f"Section {section} not found in skeleton")
-            continue
-        s.replace_with(html_snippet)
-    image_generation_requests = asyncio.gather(*collected_image_prompts)
-    css = "\n".join([x for x in css if x is not None])
-    js = "\n".join([x for x in js if x is not None])
-    skeleton_soup.head.insert(1, f"<style>\n{css}\n</style>")
-    skeleton_soup.head.insert(1, f"<script>\n{js}\n</script>")
-    output = skeleton_soup.prettify()
-    output = output.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
-    with open("index.html", "w") as f:
-        f.write(output)
-    await image_generation_requests
-    await aiohttp_session.close()
 
 
 start = time.time()
-asyncio.run(main())
+if uvloop:
+    uvloop.run(main())
+else:
+    asyncio.run(main())
 print(time.time() - start)